@@ -12,16 +12,34 @@ torch>=2.0.0
 numpy==1.24.3
 """
 
+import os
+
+# Allocator settings must be in place before torch initializes CUDA
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128")
+
 from fastapi import FastAPI, File, UploadFile, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
 from ultralytics import YOLO
-from PIL import Image
+from ultralytics.utils import ops
+from ultralytics.utils.plotting import colors
+from torchvision.io import ImageReadMode, decode_image, decode_jpeg, encode_jpeg, encode_png, read_file
+from torchvision.ops import batched_nms, box_iou
+from torchvision.utils import draw_bounding_boxes
+from PIL import Image, UnidentifiedImageError
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import fcntl
+import hashlib
 import io
+import itertools
 import logging
+import math
+import time
 import torch
+import torch.nn.functional as F
 from datetime import datetime
-import cv2
 import numpy as np
 import base64
 
@@ -32,6 +50,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Nothing here trains; grad mode is per thread, so hot paths also enter inference_mode
+torch.set_grad_enabled(False)
+
 app = FastAPI(title="YOLOv8 Detection API", version="1.0.0")
 
 # CORS middleware for frontend access - UPDATED
@@ -47,25 +68,769 @@ app.add_middleware(
 # Global model instance
 model = None
 device = None
+names = None  # class names from the predictor's backend, engine/ONNX models carry them in metadata
+
+ALLOWED_TYPES = frozenset({"image/jpeg", "image/png", "image/jpg"})
+MAX_UPLOAD_BYTES = 10 << 20
+READ_CHUNK_BYTES = 1 << 16
+
+IMG_SIZE = 640
+MAX_BATCH = 8
+IOU_THRESHOLD = 0.7
+MAX_DET = 300
+MAX_NMS = 30000  # highest-scoring candidates per image that enter NMS, as in Ultralytics
+JPEG_QUALITY = 85
+WARMUP_RUNS = 3
+BATCH_TIMEOUT = 0.005  # seconds to wait for more requests to join a batch
+INFER_TIMEOUT = 30.0  # seconds a request waits on the batcher before failing
+
+# Representative images for INT8 calibration, quantization is skipped without them
+CALIB_DIR = os.getenv("CALIB_DIR", "calib")
+CALIB_IMAGES = 500
+
+# The INT8 model must reproduce this share of the float model's detections to replace it
+PARITY_IMAGES = 8
+PARITY_CONFIDENCE = 0.25
+PARITY_RECALL = 0.9
+
+# Request coalescing queue of (tensor, ready event, confidence, future), drained by batch_inference
+request_queue = None
+batch_worker = None
+
+# Letterbox tensor ops, replaced by a compiled version on GPU
+fused_preproc = None
+
+# Persistent model input the batch worker stacks requests into
+input_buffer = None
+
+# Free preprocessing outputs keyed by (numel, dtype), reused across requests
+tensor_pool = defaultdict(list)
+
+# (graph, static input, static output, Detect head state) of the batch-1 forward pass,
+# PyTorch on CUDA only
+cuda_graph = None
+
+# Pinned host buffers for staging uploads before H2D copies (CUDA only)
+PINNED_BUFFER_BYTES = 16 << 20
+pinned_pool = None
+
+# CUDA streams so preprocess, inference and postprocess of different requests overlap
+preprocess_stream = None
+inference_stream = None
+post_stream = None
+
+
+async def read_upload(file):
+    """Read an upload in chunks, rejecting it once it exceeds MAX_UPLOAD_BYTES"""
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(413, "File too large")
+    contents = bytearray()
+    while chunk := await file.read(READ_CHUNK_BYTES):
+        contents += chunk
+        if len(contents) > MAX_UPLOAD_BYTES:
+            raise HTTPException(413, "File too large")
+    return contents
+
+
+def weights_digest(path):
+    """Short content hash of a file, so exports cached from replaced weights aren't reused"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def engine_path(weights):
+    """TensorRT engine cached next to the weights, keyed by their contents, GPU architecture and torch/TensorRT version"""
+    import tensorrt
+    stem = os.path.splitext(weights)[0]
+    major, minor = torch.cuda.get_device_capability()
+    return (
+        f"{stem}-{weights_digest(weights)}-sm{major}{minor}"
+        f"-torch{torch.__version__}-trt{tensorrt.__version__}.engine"
+    )
+
+
+def check_exported(yolo, path):
+    """Run one inference on an exported model, deleting the file if it can't serve"""
+    try:
+        # YOLO() loads lazily, so a stale or incompatible file only fails here
+        yolo.predict(
+            source=torch.zeros(1, 3, IMG_SIZE, IMG_SIZE, device=device),
+            device=device,
+            verbose=False
+        )
+    except Exception:
+        os.remove(path)
+        raise
+    return yolo
+
+
+def export_tensorrt(yolo, weights):
+    """Export weights to an FP16 TensorRT engine once and load it"""
+    path = engine_path(weights)
+    if not os.path.exists(path):
+        logger.info(f"Exporting {weights} to TensorRT engine: {path}")
+        exported = yolo.export(
+            format='engine',
+            imgsz=IMG_SIZE,
+            half=True,
+            dynamic=True,
+            batch=MAX_BATCH,
+            workspace=4
+        )
+        os.replace(exported, path)
+    return check_exported(YOLO(path, task='detect'), path)
+
+
+def export_onnx(yolo, weights):
+    """Export weights to ONNX once so CPU inference runs on ONNX Runtime, cached by their contents"""
+    path = f"{os.path.splitext(weights)[0]}-{weights_digest(weights)}.onnx"
+    if not os.path.exists(path):
+        logger.info(f"Exporting {weights} to ONNX: {path}")
+        exported = yolo.export(format='onnx', imgsz=IMG_SIZE, dynamic=True, simplify=True, opset=17)
+        os.replace(exported, path)
+    return check_exported(YOLO(path, task='detect'), path), path
+
+
+def calibration_files():
+    """Paths of the calibration images in CALIB_DIR, capped at CALIB_IMAGES"""
+    files = sorted(
+        f for f in os.listdir(CALIB_DIR)
+        if f.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )
+    return [os.path.join(CALIB_DIR, name) for name in files[:CALIB_IMAGES]]
+
+
+def calibration_digest():
+    """Short hash of the calibration set's names, sizes and mtimes"""
+    digest = hashlib.sha256()
+    for path in calibration_files():
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:12]
+
+
+def calibration_feeds(input_name):
+    """Yield letterboxed calibration images from CALIB_DIR as ONNX Runtime feeds"""
+    for path in calibration_files():
+        image = decode_image(read_file(path), mode=ImageReadMode.RGB)
+        yield {input_name: letterbox(image).unsqueeze(0).numpy()}
+
+
+def detect_head_nodes(graph):
+    """Detect head decode nodes (DFL, Sigmoid, Concat, Mul, ...) to keep in float
+
+    The head concatenates pixel-range boxes with 0-1 class scores, so a single
+    INT8 scale over its output would round every score to zero.
+    """
+    modules = {n.name.split('/')[1] for n in graph.node if n.name.startswith('/model.')}
+    prefix = '/' + max(modules, key=lambda m: int(m.split('.')[1])) + '/'
+    return [
+        n.name for n in graph.node
+        if n.name.startswith(prefix) and (n.op_type != 'Conv' or '/dfl/' in n.name)
+    ]
+
+
+def int8_recall(float_path, int8_path):
+    """Share of float ONNX detections the INT8 model reproduces on calibration images, None if unmeasurable"""
+    import onnxruntime as ort
+    float_session = ort.InferenceSession(float_path, providers=['CPUExecutionProvider'])
+    int8_session = ort.InferenceSession(int8_path, providers=['CPUExecutionProvider'])
+    input_name = float_session.get_inputs()[0].name
+    
+    matched = total = 0
+    for feed in itertools.islice(calibration_feeds(input_name), PARITY_IMAGES):
+        expected, = batched_detections(torch.from_numpy(float_session.run(None, feed)[0]), PARITY_CONFIDENCE, 1)
+        actual, = batched_detections(torch.from_numpy(int8_session.run(None, feed)[0]), PARITY_CONFIDENCE, 1)
+        total += len(expected)
+        if len(expected) and len(actual):
+            iou = box_iou(expected[:, :4], actual[:, :4])
+            iou[expected[:, 5, None] != actual[None, :, 5]] = 0
+            matched += int((iou.max(1).values >= 0.5).sum())
+    return matched / total if total else None
+
+
+def quantize_onnx(path):
+    """Statically quantize an ONNX model to INT8 once per model and calibration set, calibrating on CALIB_DIR"""
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+    
+    # The float model's name already carries the weights digest
+    int8_path = f"{os.path.splitext(path)[0]}-int8-calib{calibration_digest()}.onnx"
+    if os.path.exists(int8_path):
+        return int8_path
+    
+    float_model = onnx.load(path)
+    feeds = calibration_feeds(float_model.graph.input[0].name)
+    
+    class CalibrationImages(CalibrationDataReader):
+        def get_next(self):
+            return next(feeds, None)
+    
+    logger.info(f"Quantizing {path} to INT8 with images from {CALIB_DIR}")
+    quantize_static(
+        path,
+        int8_path,
+        CalibrationImages(),
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        nodes_to_exclude=detect_head_nodes(float_model.graph)
+    )
+    
+    # Keep the Ultralytics metadata (class names, stride, imgsz) on the quantized model
+    quantized = onnx.load(int8_path)
+    onnx.helper.set_model_props(
+        quantized, {prop.key: prop.value for prop in float_model.metadata_props}
+    )
+    onnx.save(quantized, int8_path)
+    return int8_path
+
+
+def tune_onnx_session(path):
+    """Rebuild the predictor's ONNX Runtime session with full graph fusions and sized thread pool"""
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = max(os.cpu_count() // 2, 1)
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    model.predictor.model.session = ort.InferenceSession(
+        path, options, providers=['CPUExecutionProvider']
+    )
+
+
+def warmup(onnx_path=None):
+    """Run dummy inferences so the first request doesn't pay cuDNN autotuning or engine setup"""
+    dummy = torch.zeros(3, IMG_SIZE, IMG_SIZE, dtype=torch.uint8, device=device)
+    input_buffer.copy_(preprocess(dummy))
+    # The predictor (and its backend and session) only exists after the first predict
+    model.predict(source=input_buffer[:1], device=device, verbose=False)
+    if onnx_path is not None:
+        tune_onnx_session(onnx_path)
+    
+    # Every batch size the batcher can form is a new shape for cuDNN and TensorRT
+    with torch.inference_mode():
+        for size in range(1, MAX_BATCH + 1):
+            for _ in range(WARMUP_RUNS):
+                forward(input_buffer[:size])
+
+
+def on_stream(stream):
+    """Context running work on a CUDA stream, a no-op on CPU"""
+    return torch.cuda.stream(stream) if stream is not None else nullcontext()
+
+
+def record_event(stream):
+    """Record a CUDA event on a stream, None on CPU"""
+    if stream is None:
+        return None
+    event = torch.cuda.Event()
+    event.record(stream)
+    return event
+
+
+def allocate_pinned_pool():
+    """Allocate pinned staging buffers for two batches, one running and one filling"""
+    pool = asyncio.Queue()
+    for _ in range(2 * MAX_BATCH):
+        pool.put_nowait(torch.empty(PINNED_BUFFER_BYTES, dtype=torch.uint8, pin_memory=True))
+    return pool
+
+
+@asynccontextmanager
+async def pinned_buffer():
+    """Check out a pinned staging buffer for one request, yields None on CPU"""
+    if pinned_pool is None:
+        yield None
+        return
+    buf = await pinned_pool.get()
+    try:
+        yield buf
+    finally:
+        # Shielded so a cancelled request still returns its buffer to the pool
+        await asyncio.shield(release_pinned(buf, record_event(preprocess_stream)))
+
+
+async def release_pinned(buf, copied):
+    """Return a staging buffer once the copies out of it have landed, without blocking the loop"""
+    while not copied.query():
+        await asyncio.sleep(0)
+    pinned_pool.put_nowait(buf)
+
+
+def decode_draft(contents):
+    """Decode a JPEG with libjpeg's DCT downscaling to roughly the model input size"""
+    image = Image.open(io.BytesIO(contents))
+    size = image.size
+    image.draft('RGB', (IMG_SIZE, IMG_SIZE))
+    image = image.convert('RGB')
+    return torch.from_numpy(np.array(image)).permute(2, 0, 1), (size[1], size[0])
+
+
+def check_dimensions(contents):
+    """Reject uploads whose header declares more pixels than Pillow allows
+
+    torchvision's decoders have no pixel limit, so a small file can still
+    decode to gigabytes. Image.open only parses the header here.
+    """
+    try:
+        with Image.open(io.BytesIO(contents)) as image:
+            width, height = image.size
+    except Image.DecompressionBombError as e:
+        raise HTTPException(413, str(e))
+    except UnidentifiedImageError:
+        raise HTTPException(400, "Cannot identify image file")
+    if width * height > Image.MAX_IMAGE_PIXELS:
+        raise HTTPException(413, f"Image too large: {width}x{height} pixels")
+
+
+def decode_upload(contents, content_type, staging=None):
+    """Decode uploaded bytes to a uint8 RGB CHW tensor on device
+
+    Returns the tensor and the upload's original (height, width), which differs
+    from the tensor's when the JPEG was decoded at reduced scale.
+    """
+    check_dimensions(contents)
+    if device == 'cpu' and content_type in ("image/jpeg", "image/jpg"):
+        return decode_draft(contents)
+    
+    data = torch.frombuffer(contents, dtype=torch.uint8)
+    if staging is not None and data.numel() <= staging.numel():
+        data = staging[:data.numel()].copy_(data)
+    if device == 'cuda' and content_type in ("image/jpeg", "image/jpg"):
+        try:
+            # nvJPEG decodes straight into device memory
+            image = decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+            return image, tuple(image.shape[1:])
+        except torch.cuda.OutOfMemoryError:
+            raise
+        except RuntimeError:
+            pass  # e.g. CMYK or progressive JPEGs nvJPEG can't handle
+    image = decode_image(data, mode=ImageReadMode.RGB)
+    if staging is not None and image.numel() <= staging.numel():
+        # Raw bytes are consumed, reuse the buffer so the H2D copy is a DMA
+        image = staging[:image.numel()].view(image.shape).copy_(image)
+    return image.to(device, non_blocking=True), tuple(image.shape[1:])
+
+
+def acquire_tensor(shape, dtype):
+    """Take a tensor from the pool, allocating only when none of that size is free"""
+    free = tensor_pool[(math.prod(shape), dtype)]
+    if free:
+        return free.pop().view(shape)
+    return torch.empty(shape, dtype=dtype, device=device)
+
+
+def release_tensor(tensor):
+    """Return a tensor to the pool once no pending work reads it"""
+    tensor_pool[(tensor.numel(), tensor.dtype)].append(tensor)
+
+
+def letterbox_geometry(h, w):
+    """Resized (height, width) and (top, left) padding of an h x w image in the model input"""
+    r = min(IMG_SIZE / h, IMG_SIZE / w)
+    nh, nw = round(h * r), round(w * r)
+    top = round((IMG_SIZE - nh) / 2 - 0.1)
+    left = round((IMG_SIZE - nw) / 2 - 0.1)
+    return nh, nw, top, left
+
+
+def letterbox_kernel(image, out, nh, nw, top, left):
+    """Resize, pad and normalize into out, the tensor ops of letterbox"""
+    resized = F.interpolate(
+        image.unsqueeze(0).to(out.dtype) / 255,
+        size=(nh, nw),
+        mode='bilinear',
+        align_corners=False
+    )
+    out.fill_(114 / 255)
+    out[:, top:top + nh, left:left + nw] = resized[0]
+    return out
+
+
+def letterbox(image, out=None, kernel=letterbox_kernel):
+    """Resize, pad and normalize a uint8 CHW image into the model input, like Ultralytics' LetterBox"""
+    if out is None:
+        dtype = torch.float16 if image.is_cuda else torch.float32
+        out = torch.empty((3, IMG_SIZE, IMG_SIZE), dtype=dtype, device=image.device)
+    # Geometry stays in Python so a compiled kernel only sees it as integer inputs
+    return kernel(image, out, *letterbox_geometry(*image.shape[1:]))
+
+
+def compile_preprocess():
+    """Fuse the letterbox tensor ops into a single kernel with torch.compile on GPU"""
+    global fused_preproc
+    fused_preproc = letterbox_kernel
+    if device != 'cuda':
+        return
+    try:
+        compiled = torch.compile(letterbox_kernel, dynamic=True)
+        # Warm up the way requests call it: inference_mode, pooled out, square, landscape and portrait inputs
+        with torch.inference_mode():
+            out = acquire_tensor((3, IMG_SIZE, IMG_SIZE), input_buffer.dtype)
+            for h, w in ((IMG_SIZE, IMG_SIZE), (IMG_SIZE * 3 // 4, IMG_SIZE), (IMG_SIZE, IMG_SIZE * 3 // 4)):
+                letterbox(torch.zeros(3, h, w, dtype=torch.uint8, device=device), out, compiled)
+            release_tensor(out)
+        fused_preproc = compiled
+    except Exception as e:
+        logger.warning(f"torch.compile failed for preprocessing: {e}. Running eager")
+
+
+def preprocess(image, out=None):
+    """Letterbox through the compiled kernel, dropping back to eager for good if it fails"""
+    global fused_preproc
+    try:
+        return letterbox(image, out, fused_preproc)
+    except Exception as e:
+        if fused_preproc is letterbox_kernel:
+            raise
+        logger.warning(f"Compiled preprocessing failed: {e}. Running eager")
+        fused_preproc = letterbox_kernel
+        return letterbox(image, out)
+
+
+def scale_detections(detections, shape):
+    """Map letterboxed (x1, y1, x2, y2, conf, cls) rows back onto an image of the given shape"""
+    boxes = detections.clone()
+    boxes[:, :4] = ops.scale_boxes((IMG_SIZE, IMG_SIZE), boxes[:, :4], shape)
+    return boxes
+
+
+def upload_resolution(contents, image, boxes, gain):
+    """Image and boxes in the upload's own pixels for annotation
+
+    Draft-decoded JPEGs are decoded again at full size, so annotated responses
+    keep the upload's resolution and line up with the reported bboxes.
+    """
+    if not bool((gain != 1).any()):
+        return image, boxes
+    full = decode_image(torch.frombuffer(contents, dtype=torch.uint8), mode=ImageReadMode.RGB)
+    boxes = boxes.clone()
+    boxes[:, :4] *= gain
+    return full, boxes
+
+
+def draw_detections(image, boxes):
+    """Draw detections on the decoded RGB CHW image in the Ultralytics palette, returns it on CPU"""
+    labels = [f"{names[int(cls)]} {conf:.2f}" for conf, cls in boxes[:, 4:].tolist()]
+    palette = [colors(int(cls)) for cls in boxes[:, 5].tolist()]
+    return draw_bounding_boxes(
+        image.cpu(),
+        boxes[:, :4].cpu(),
+        labels=labels,
+        colors=palette,
+        width=max(round(sum(image.shape[1:]) / 2 * 0.003), 2)
+    )
+
+
+def annotate_jpeg(image, boxes):
+    """Draw detections on the decoded image and encode it as JPEG bytes"""
+    return encode_jpeg(draw_detections(image, boxes), quality=JPEG_QUALITY).numpy().tobytes()
+
+
+def annotate_png(image, boxes):
+    """Draw detections on the decoded image and encode it as PNG bytes"""
+    return encode_png(draw_detections(image, boxes)).numpy().tobytes()
+
+
+def capture_graph():
+    """Capture the PyTorch forward pass for one IMG_SIZE input as a CUDA graph"""
+    backend = model.predictor.model
+    if not backend.pt:
+        return None  # TensorRT and ONNX Runtime run their own graphs
+    
+    net = backend.model
+    static_in = torch.zeros(
+        (1, 3, IMG_SIZE, IMG_SIZE),
+        dtype=torch.float16 if backend.fp16 else torch.float32,
+        device=device
+    )
+    
+    # Warm up on a side stream so capture sees cached anchors and cuDNN plans
+    side = torch.cuda.Stream()
+    side.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side), torch.inference_mode():
+        for _ in range(WARMUP_RUNS):
+            net(static_in)
+    torch.cuda.current_stream().wait_stream(side)
+    
+    graph = torch.cuda.CUDAGraph()
+    with torch.inference_mode(), torch.cuda.graph(graph):
+        static_out = net(static_in)[0]
+    
+    # Detect swaps in new anchor/stride tensors whenever the input shape (batch included)
+    # changes, so hold the ones the graph reads to keep their memory alive
+    head = net.model[-1]
+    return graph, static_in, static_out, (head, head.anchors, head.strides, head.shape)
+
+
+def replay_graph(tensor):
+    """Run a single input through the captured graph, returns the static raw predictions"""
+    graph, static_in, static_out, (head, anchors, strides, shape) = cuda_graph
+    head.anchors, head.strides, head.shape = anchors, strides, shape
+    static_in.copy_(tensor.unsqueeze(0))
+    graph.replay()
+    return static_out
+
+
+def forward(batch):
+    """Raw predictions through Ultralytics' backend, whether PyTorch, TensorRT or ONNX Runtime"""
+    backend = model.predictor.model
+    preds = backend(batch.to(torch.float16 if backend.fp16 else torch.float32))
+    return preds[0] if isinstance(preds, (list, tuple)) else preds
+
+
+def batched_detections(preds, confidence, count):
+    """Run NMS for a whole batch of raw (B, 4 + nc, anchors) predictions in one call
+
+    Returns letterboxed (x1, y1, x2, y2, conf, cls) rows for each of the count images.
+    """
+    nc = preds.shape[1] - 4
+    preds = preds.float().transpose(1, 2)
+    scores, classes = preds[..., 4:].max(-1)
+    image_idx, anchor_idx = (scores > confidence).nonzero(as_tuple=True)
+    scores = scores[image_idx, anchor_idx]
+    
+    # Keep each image's MAX_NMS best candidates like Ultralytics, only possible to exceed past MAX_NMS in total
+    if len(scores) > MAX_NMS:
+        order = torch.argsort(scores, descending=True, stable=True)
+        order = order[torch.argsort(image_idx[order], stable=True)]
+        per_image = torch.bincount(image_idx, minlength=count)
+        starts = torch.cumsum(per_image, 0) - per_image
+        rank = torch.arange(len(order), device=order.device) - starts[image_idx[order]]
+        order = order[rank < MAX_NMS]
+        image_idx, anchor_idx, scores = image_idx[order], anchor_idx[order], scores[order]
+    
+    boxes = ops.xywh2xyxy(preds[image_idx, anchor_idx, :4])
+    classes = classes[image_idx, anchor_idx]
+    
+    # Offsetting class ids per image keeps NMS within each image and class
+    keep = batched_nms(boxes, scores, image_idx * nc + classes, IOU_THRESHOLD)
+    keep = keep[torch.argsort(image_idx[keep], stable=True)]
+    rows = torch.cat((boxes[keep], scores[keep, None], classes[keep, None].float()), 1)
+    counts = torch.bincount(image_idx[keep], minlength=count).tolist()
+    return [image_rows[:MAX_DET] for image_rows in rows.split(counts)]
+
+
+def predict_batch(tensors, ready, confidences):
+    """Run one batched inference on the inference stream once every input is ready
+
+    Returns letterboxed (x1, y1, x2, y2, conf, cls) rows per input, filtered to that
+    input's confidence, and an event marking them ready.
+    """
+    with on_stream(inference_stream), torch.inference_mode():
+        for tensor, event in zip(tensors, ready):
+            if event is not None:
+                inference_stream.wait_event(event)
+                tensor.record_stream(inference_stream)
+        
+        if cuda_graph is not None and len(tensors) == 1:
+            preds = replay_graph(tensors[0])
+        else:
+            batch = torch.stack(tensors, out=input_buffer[:len(tensors)])
+            if inference_stream is not None and model.predictor.model.engine:
+                # TensorRT's execute_v2 reads the raw pointer off PyTorch's streams
+                inference_stream.synchronize()
+            preds = forward(batch)
+        # Run at the lowest requested threshold, then filter per request with NMS's strict
+        # comparison on this same stream so the returned event covers every tensor handed back.
+        # NMS consumes graph output before the next replay can overwrite it
+        detections = batched_detections(preds, min(confidences), len(tensors))
+        detections = [rows[rows[:, 4] > conf] for rows, conf in zip(detections, confidences)]
+        return detections, record_event(inference_stream)
+
+
+async def run_batch(loop, batch):
+    """Collect more requests behind the first one, run them as one batch and resolve their futures"""
+    deadline = loop.time() + BATCH_TIMEOUT
+    while len(batch) < MAX_BATCH:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(request_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    
+    # Requests that timed out while queued have no one waiting on their result
+    batch = [entry for entry in batch if not entry[3].done()]
+    if not batch:
+        return
+    
+    tensors = [tensor for tensor, _, _, _ in batch]
+    ready = [event for _, event, _, _ in batch]
+    confidences = [conf for _, _, conf, _ in batch]
+    detections, done = await loop.run_in_executor(
+        None, predict_batch, tensors, ready, confidences
+    )
+    
+    for (_, _, _, future), rows in zip(batch, detections):
+        if not future.done():
+            future.set_result((rows, done))
+
+
+async def batch_inference():
+    """Coalesce queued requests into a single batched inference call"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await request_queue.get()]
+        try:
+            await run_batch(loop, batch)
+        except Exception as e:
+            # Fail this batch's requests but keep the worker alive for the next ones
+            logger.error(f"Batch inference failed: {str(e)}")
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+async def infer(tensor, ready, confidence):
+    """Queue a preprocessed image for batching, returns (letterboxed detections, ready event)"""
+    future = asyncio.get_running_loop().create_future()
+    await request_queue.put((tensor, ready, confidence, future))
+    try:
+        return await asyncio.wait_for(future, INFER_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(504, f"Inference timed out after {INFER_TIMEOUT:g}s")
+
+
+async def detect(contents, content_type, confidence):
+    """Decode, preprocess and run an upload through the batcher
+
+    Returns the decoded image, its boxes in image pixels, and the per-coordinate
+    gain mapping those boxes back onto the original upload.
+    """
+    async with pinned_buffer() as staging:
+        with on_stream(preprocess_stream), torch.inference_mode():
+            image, (orig_h, orig_w) = decode_upload(contents, content_type, staging)
+            tensor = preprocess(image, acquire_tensor((3, IMG_SIZE, IMG_SIZE), input_buffer.dtype))
+            preprocessed = record_event(preprocess_stream)
+    # The upload only lives in the staging buffer until it is on device, so it
+    # is released before waiting on the batcher
+    detections, inferred = await infer(tensor, preprocessed, confidence)
+    
+    # The batch has been stacked, so the input can go back to the pool
+    if inferred is not None:
+        preprocess_stream.wait_event(inferred)
+    release_tensor(tensor)
+    
+    with on_stream(post_stream), torch.inference_mode():
+        if inferred is not None:
+            post_stream.wait_event(inferred)
+            detections.record_stream(post_stream)
+        boxes = scale_detections(detections, image.shape[1:])
+        h, w = image.shape[1:]
+        gain = boxes.new_tensor([orig_w / w, orig_h / h, orig_w / w, orig_h / h])
+    
+    # Hand the image and boxes back to the default stream for D2H and annotation
+    if post_stream is not None:
+        current = torch.cuda.current_stream()
+        current.wait_stream(preprocess_stream)
+        current.wait_stream(post_stream)
+        image.record_stream(current)
+        boxes.record_stream(current)
+        gain.record_stream(current)
+    return image, boxes, gain
+
+
+@contextmanager
+def export_lock(weights):
+    """Hold an exclusive file lock so concurrent uvicorn workers don't export over each other"""
+    with open(weights + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def select_backend(yolo, weights):
+    """Swap the PyTorch model for the fastest exported backend that loads, returns (model, onnx path)"""
+    # Swap in a TensorRT engine on GPU, keep the PyTorch model if export fails
+    if device == 'cuda':
+        try:
+            yolo = export_tensorrt(yolo, weights)
+            logger.info("Loaded TensorRT engine")
+        except Exception as e:
+            logger.warning(f"TensorRT export failed: {e}. Using {weights}")
+    
+    # On CPU serve through ONNX Runtime instead of eager PyTorch
+    onnx_path = None
+    if device == 'cpu':
+        try:
+            yolo, onnx_path = export_onnx(yolo, weights)
+            logger.info("Loaded ONNX model")
+        except Exception as e:
+            logger.warning(f"ONNX export failed: {e}. Using {weights}")
+    
+    if onnx_path is not None and os.path.isdir(CALIB_DIR):
+        int8_path = None
+        try:
+            int8_path = quantize_onnx(onnx_path)
+            recall = int8_recall(onnx_path, int8_path)
+            if recall is None or recall < PARITY_RECALL:
+                raise ValueError(f"INT8 model reproduces {recall} of float detections")
+            onnx_path = int8_path
+            yolo = YOLO(onnx_path, task='detect')
+            logger.info(f"Loaded INT8 ONNX model, detection recall {recall:.2f}")
+        except Exception as e:
+            logger.warning(f"INT8 quantization failed: {e}. Using float ONNX model")
+            # Drop the cached INT8 model so a better calibration set is picked up next start
+            if int8_path is not None and os.path.exists(int8_path):
+                os.remove(int8_path)
+    
+    return yolo, onnx_path
+
 
 @app.on_event("startup")
 async def load_model():
     """Load YOLOv8 model on startup"""
-    global model, device
+    global model, device, names, request_queue, batch_worker, pinned_pool
+    global preprocess_stream, inference_stream, post_stream, input_buffer, cuda_graph
     try:
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
         logger.info(f"Loading model on device: {device}")
         
         # Try different model paths
         try:
-            model = YOLO('best.pt')
+            weights = 'best.pt'
+            model = YOLO(weights)
             logger.info("Loaded custom model: best.pt")
         except Exception as e:
             logger.warning(f"Could not load best.pt: {e}. Using yolov8n.pt")
-            model = YOLO('yolov8n.pt')
+            weights = 'yolov8n.pt'
+            model = YOLO(weights)
             logger.info("Loaded pretrained model: yolov8n.pt")
             
         model.to(device)
+        
+        # Exports share files next to the weights, so only one worker builds them at a time
+        with export_lock(weights):
+            model, onnx_path = select_backend(model, weights)
+        
+        torch.backends.cudnn.benchmark = True
+        input_buffer = torch.empty(
+            (MAX_BATCH, 3, IMG_SIZE, IMG_SIZE),
+            dtype=torch.float16 if device == 'cuda' else torch.float32,
+            device=device
+        )
+        compile_preprocess()
+        warmup(onnx_path)
+        # YOLO('*.engine') / YOLO('*.onnx') expose no names until the backend is loaded
+        names = model.predictor.model.names
+        if device == 'cuda':
+            try:
+                cuda_graph = capture_graph()
+            except Exception as e:
+                logger.warning(f"CUDA graph capture failed: {e}. Using eager forward")
+        
+        if device == 'cuda':
+            pinned_pool = allocate_pinned_pool()
+            preprocess_stream = torch.cuda.Stream()
+            inference_stream = torch.cuda.Stream()
+            post_stream = torch.cuda.Stream()
+        request_queue = asyncio.Queue()
+        batch_worker = asyncio.create_task(batch_inference())
         logger.info("Model loaded successfully")
     except Exception as e:
         logger.error(f"Failed to load model: {str(e)}")
@@ -80,7 +845,7 @@ async def root():
         "device": device,
         "timestamp": datetime.now().isoformat(),
         "endpoints": {
-            "POST /detect": "Detect objects in image",
+            "POST /detect": "Detect objects in image (annotate=false returns headers only)",
             "POST /detect-json": "Detect objects with JSON response",
             "GET /health": "Detailed health check"
         }
@@ -89,7 +854,8 @@ async def root():
 @app.post("/detect")
 async def detect_objects(
     file: UploadFile = File(...),
-    confidence: float = Query(0.25, ge=0.0, le=1.0, description="Confidence threshold")
+    confidence: float = Query(0.25, ge=0.0, le=1.0, description="Confidence threshold"),
+    annotate: bool = Query(True, description="Return the annotated image, headers only if false")
 ):
     """
     Detect objects in uploaded image
@@ -97,58 +863,30 @@ async def detect_objects(
     Args:
         file: Image file (JPEG, PNG)
         confidence: Detection confidence threshold (0.0-1.0)
+        annotate: Draw and return the annotated image (False returns an empty body)
     
     Returns:
         Annotated image with bounding boxes
     """
-    start_time = datetime.now()
+    start_ns = time.perf_counter_ns()
     
     try:
         # Validate file type
-        if file.content_type not in ["image/jpeg", "image/png", "image/jpg"]:
-            raise HTTPException(400, "Invalid file type. Use JPEG or PNG")
+        if file.content_type not in ALLOWED_TYPES:
+            raise HTTPException(415, "Invalid file type. Use JPEG or PNG")
         
         # Read and process image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        contents = await read_upload(file)
         
         # Run inference
         logger.info(f"Running detection on {file.filename}")
-        results = model.predict(
-            source=image,
-            conf=confidence,
-            device=device,
-            verbose=False
-        )
+        image, boxes, gain = await detect(contents, file.content_type, confidence)
         
-        # Check if objects were detected
-        boxes = results[0].boxes
-        detection_count = 0
-        max_confidence = 0.0
-        detections_list = []
+        # Check if objects were detected, the headers only need the count and best score
+        detection_count = len(boxes)
+        max_confidence = float(boxes[:, 4].max()) if detection_count > 0 else 0.0
         
-        if boxes is not None and len(boxes) > 0:
-            detection_count = len(boxes)
-            confidences = boxes.conf.cpu().numpy()
-            classes = boxes.cls.cpu().numpy()
-            names = results[0].names
-            
-            # Create detections list
-            for i in range(len(boxes)):
-                box = boxes.xyxy[i].cpu().numpy()
-                detections_list.append({
-                    "class": names[int(classes[i])],
-                    "confidence": float(confidences[i]),
-                    "bbox": box.tolist()
-                })
-            
-            max_confidence = float(confidences.max()) if len(confidences) > 0 else 0.0
-        
-        processing_time = (datetime.now() - start_time).total_seconds()
+        processing_time = (time.perf_counter_ns() - start_ns) / 1e9
         
         # Create headers
         headers = {
@@ -160,24 +898,22 @@ async def detect_objects(
         }
         
         if detection_count > 0:
-            # Annotate image with bounding boxes
-            annotated = results[0].plot()
-            annotated_rgb = cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB)
-            annotated_image = Image.fromarray(annotated_rgb)
-            
-            # Convert to bytes
-            img_byte_arr = io.BytesIO()
-            annotated_image.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            
             logger.info(
                 f"Objects detected in {file.filename}: count={detection_count}, "
                 f"max_confidence={max_confidence:.2f}, time={processing_time:.2f}s"
             )
             
+            # Presence-only callers get the detection headers without drawing
+            if not annotate:
+                return StreamingResponse(io.BytesIO(), headers=headers)
+            
+            # Annotate image with bounding boxes
+            image, boxes = upload_resolution(contents, image, boxes, gain)
+            img_byte_arr = io.BytesIO(annotate_jpeg(image, boxes))
+            
             return StreamingResponse(
                 img_byte_arr,
-                media_type="image/png",
+                media_type="image/jpeg",
                 headers=headers
             )
         else:
@@ -190,11 +926,13 @@ async def detect_objects(
                 headers=headers
             )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing {file.filename}: {str(e)}")
         raise HTTPException(500, f"Processing failed: {str(e)}")
 
-@app.post("/detect-json")
+@app.post("/detect-json", response_class=ORJSONResponse)
 async def detect_objects_json(
     file: UploadFile = File(...),
     confidence: float = Query(0.25, ge=0.0, le=1.0)
@@ -202,89 +940,76 @@ async def detect_objects_json(
     """
     Detect objects with JSON response (for debugging)
     """
-    start_time = datetime.now()
+    start_ns = time.perf_counter_ns()
     
     try:
         # Validate file type
-        if file.content_type not in ["image/jpeg", "image/png", "image/jpg"]:
+        if file.content_type not in ALLOWED_TYPES:
             return JSONResponse(
-                status_code=400,
+                status_code=415,
                 content={"error": "Invalid file type. Use JPEG or PNG"}
             )
         
         # Read and process image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        contents = await read_upload(file)
         
         # Run inference
         logger.info(f"Running detection (JSON) on {file.filename}")
-        results = model.predict(
-            source=image,
-            conf=confidence,
-            device=device,
-            verbose=False
-        )
+        image, boxes, gain = await detect(contents, file.content_type, confidence)
         
-        # Process results
-        boxes = results[0].boxes
-        detection_count = 0
+        # Process results as parallel arrays, orjson encodes the numpy columns directly
+        detection_count = len(boxes)
         max_confidence = 0.0
-        detections_list = []
+        detections = {"classes": [], "confidences": [], "bboxes": []}
         
-        if boxes is not None and len(boxes) > 0:
-            detection_count = len(boxes)
-            confidences = boxes.conf.cpu().numpy()
-            classes = boxes.cls.cpu().numpy()
-            names = results[0].names
-            
-            for i in range(len(boxes)):
-                box = boxes.xyxy[i].cpu().numpy()
-                detections_list.append({
-                    "class": names[int(classes[i])],
-                    "confidence": float(confidences[i]),
-                    "bbox": box.tolist()
-                })
+        if detection_count > 0:
+            # Single D2H copy of every box, confidence and class
+            data = torch.cat((boxes[:, :4] * gain, boxes[:, 4:]), 1).cpu().numpy()
+            detections = {
+                "classes": [names[cls] for cls in data[:, 5].astype(int).tolist()],
+                "confidences": np.ascontiguousarray(data[:, 4]),
+                "bboxes": np.ascontiguousarray(data[:, :4])
+            }
             
-            max_confidence = float(confidences.max()) if len(confidences) > 0 else 0.0
+            max_confidence = float(data[:, 4].max())
         
-        processing_time = (datetime.now() - start_time).total_seconds()
+        processing_time = (time.perf_counter_ns() - start_ns) / 1e9
         
         # Also generate annotated image for base64
         if detection_count > 0:
-            annotated = results[0].plot()
-            annotated_rgb = cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB)
-            annotated_image = Image.fromarray(annotated_rgb)
-            img_byte_arr = io.BytesIO()
-            annotated_image.save(img_byte_arr, format='PNG')
-            img_base64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+            image, boxes = upload_resolution(contents, image, boxes, gain)
+            media_type = "image/png"
+            img_base64 = base64.b64encode(annotate_png(image, boxes))
         else:
-            img_base64 = base64.b64encode(contents).decode('utf-8')
+            media_type = file.content_type
+            img_base64 = base64.b64encode(contents)
         
         logger.info(
             f"JSON detection for {file.filename}: count={detection_count}, "
             f"time={processing_time:.2f}s"
         )
         
-        return {
+        # Returned directly so FastAPI skips jsonable_encoder and orjson does the encoding;
+        # orjson has no bytes type, but decoding base64 output as ASCII is a plain copy
+        return ORJSONResponse({
             "success": True,
             "objects_found": detection_count > 0,
             "detection_count": detection_count,
             "max_confidence": max_confidence,
             "processing_time": processing_time,
-            "detections": detections_list,
+            "detections": detections,
             "filename": file.filename,
-            "image_base64": f"data:image/png;base64,{img_base64}" if detection_count > 0 else f"data:{file.content_type};base64,{img_base64}"
-        }
+            "image_base64": f"data:{media_type};base64," + img_base64.decode('ascii')
+        })
         
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
     except Exception as e:
         logger.error(f"Error in JSON detection: {str(e)}")
-        return {
+        return ORJSONResponse({
             "success": False,
             "error": str(e)
-        }
+        })
 
 @app.get("/health")
 async def health_check():
@@ -317,4 +1042,13 @@ async def test_headers():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Workers each load their own model and batcher; an import string is required for workers > 1
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WORKERS", "2")),
+        loop="uvloop",
+        http="httptools",
+        log_level="info"
+    )
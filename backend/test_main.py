@@ -0,0 +1,45 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("fastapi")
+ops = pytest.importorskip("ultralytics.utils.ops")
+
+import main
+
+
+def random_preds(batch, nc=3, anchors=2000, seed=0):
+    """Raw (B, 4 + nc, anchors) head output with clustered boxes so NMS has overlaps to suppress"""
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.rand(batch, 2, anchors, generator=generator) * 64 + 288
+    sizes = torch.rand(batch, 2, anchors, generator=generator) * 120 + 8
+    scores = torch.rand(batch, nc, anchors, generator=generator) ** 4
+    return torch.cat((centers, sizes, scores), 1)
+
+
+def reference(preds, confidence, max_nms=30000):
+    return ops.non_max_suppression(
+        preds,
+        confidence,
+        main.IOU_THRESHOLD,
+        max_det=main.MAX_DET,
+        max_nms=max_nms,
+        max_time_img=60.0
+    )
+
+
+@pytest.mark.parametrize("batch", [1, 2, 3])
+@pytest.mark.parametrize("confidence", [0.25, 0.5])
+def test_batched_detections_match_ultralytics(batch, confidence):
+    preds = random_preds(batch, seed=batch)
+    ours = main.batched_detections(preds, confidence, batch)
+    assert len(ours) == batch
+    for rows, expected in zip(ours, reference(preds, confidence)):
+        torch.testing.assert_close(rows, expected)
+
+
+def test_batched_detections_cap_candidates(monkeypatch):
+    monkeypatch.setattr(main, "MAX_NMS", 500)
+    preds = random_preds(3, seed=7)
+    for rows, expected in zip(main.batched_detections(preds, 0.25, 3), reference(preds, 0.25, max_nms=500)):
+        torch.testing.assert_close(rows, expected)
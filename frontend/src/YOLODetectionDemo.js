@@ -65,12 +65,15 @@ export default function YOLODetectionDemo() {
         setResultUrl(data.image_base64);
       }
 
+      // Detections arrive as parallel arrays (classes, confidences, bboxes)
+      const { classes = [], confidences = [] } = data.detections || {};
+
       setDetectionInfo({
         found: data.objects_found,
         count: data.detection_count,
         confidence: data.max_confidence,
         time: data.processing_time,
-        detections: data.detections || [],
+        detections: classes.map((cls, i) => ({ class: cls, confidence: confidences[i] })),
         rawData: data
       });
 